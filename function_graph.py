@@ -1,26 +1,41 @@
 #!/usr/bin/env python3
 import sys
-import pprint
 import os
 import collections
 import argparse
 
 from solidity_parser import parser
 
+SHAPES = {"Function": "box", "Modifier": "house", "Event": "oval"}
+SELF_REFERENCES = frozenset(("this", "super"))
+# AST nodes that can't hold a function call, the walker doesn't look inside them
+LEAF_TYPES = frozenset(("Identifier", "NumberLiteral", "StringLiteral", "HexLiteral",
+                        "BooleanLiteral", "ElementaryTypeName", "ElementaryTypeNameExpression",
+                        "UserDefinedTypeName"))
+
 class Contract():
+    __slots__ = ("name", "base_contracts", "state_user_vars", "usingfors", "functions",
+                 "functions_by_name", "linearization", "linearization_set", "base_cache")
+
     def __init__(self, name):
         self.name = name
         self.base_contracts = []
         self.state_user_vars = {}
         self.usingfors = {}
         self.functions = {}
+        self.functions_by_name = {}
         self.linearization = []
+        self.linearization_set = frozenset()
+        self.base_cache = {}
 
 class Function():
+    __slots__ = ("name", "params", "type", "_hash")
+
     def __init__(self, name, params, fun_type="Function"):
         self.name = name
         self.params = params
         self.type = fun_type;
+        self._hash = hash((name, params, fun_type))
 
     def __eq__(self, other):
         return (self.name == other.name and
@@ -28,36 +43,42 @@ class Function():
                 self.type == other.type)
 
     def __hash__(self):
-        return hash(self.name)
+        return self._hash
 
     def __repr__(self):
         return f"{self.name}:{self.params}"
 
 class Call():
+    __slots__ = ("contract", "function", "context", "_hash")
+
     def __init__(self, contract, function, context=None):
         self.contract = contract
         self.function = function
         self.context = context or contract
+        self._hash = hash((contract, function))
 
     def __eq__(self, other):
         return self.contract == other.contract and self.function == other.function
 
     def __hash__(self):
-        return hash(self.function)
+        return self._hash
 
     def __repr__(self):
         return f"{self.contract}:{self.function}"
 
 class Edge():
+    __slots__ = ("caller", "callee", "_hash")
+
     def __init__(self, caller, callee):
         self.caller = caller
         self.callee = callee
+        self._hash = hash((caller, callee))
 
     def __eq__(self, other):
         return self.caller == other.caller and self.callee == other.callee
 
     def __hash__(self):
-        return hash(self.callee)
+        return self._hash
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -65,187 +86,286 @@ def eprint(*args, **kwargs):
 def parse_contracts(path):
     contracts = {}
     to_parse = [path]
-    for path in to_parse:
-        source = parser.parse_file(path)
-        for directive in source["children"]:
-            if directive["type"] == "ImportDirective":
-                new_path = directive["path"]
-                if new_path[0] == '.':
-                    new_path = os.path.join(os.path.dirname(path), new_path)
-                if (os.path.isfile(new_path) and
-                    not any(os.path.samefile(new_path, p) for p in to_parse)):
-                    to_parse.append(new_path)
-            # Parse contracts
-            # Libraries and interfaces are contracts
-            if directive["type"] == "ContractDefinition":
-                name = directive["name"]
-                contracts[name] = Contract(name)
-                # Solidity does c3 linearization in reverse (Right to Left)
-                bases = [b["baseName"]["namePath"] for b in reversed(directive["baseContracts"])]
-                contracts[name].base_contracts = bases
-                for node in directive["subNodes"]:
-                    parse_node(contracts[name], node)
+    # Import paths resolved to their real path, the same import shows up in many files
+    real_paths = {}
+    seen = {os.path.realpath(path)}
+    # Files are parsed a level of imports at a time, in parallel when there are many.
+    # The pool is only started once a level has more than one file.
+    executor = None
+    parallel = True
+    try:
+        while to_parse:
+            sources = None
+            if len(to_parse) > 1 and parallel:
+                try:
+                    if executor is None:
+                        import concurrent.futures
+                        executor = concurrent.futures.ProcessPoolExecutor()
+                    sources = executor.map(parser.parse_file, to_parse)
+                except (ImportError, NotImplementedError, OSError):
+                    # This platform can't run a process pool, parse in process
+                    parallel = False
+            if sources is None:
+                sources = map(parser.parse_file, to_parse)
+            imports = []
+            for path, source in zip(to_parse, sources):
+                directory = os.path.dirname(path)
+                for directive in source["children"]:
+                    if directive["type"] == "ImportDirective":
+                        new_path = directive["path"]
+                        if new_path[0] == '.':
+                            new_path = os.path.join(directory, new_path)
+                        if new_path not in real_paths:
+                            real_paths[new_path] = os.path.realpath(new_path)
+                        real_path = real_paths[new_path]
+                        if real_path not in seen and os.path.isfile(new_path):
+                            seen.add(real_path)
+                            imports.append(new_path)
+                    # Parse contracts
+                    # Libraries and interfaces are contracts
+                    if directive["type"] == "ContractDefinition":
+                        name = directive["name"]
+                        contracts[name] = Contract(name)
+                        # Solidity does c3 linearization in reverse (Right to Left)
+                        bases = [b["baseName"]["namePath"] for b in reversed(directive["baseContracts"])]
+                        contracts[name].base_contracts = bases
+                        for node in directive["subNodes"]:
+                            parse_node(contracts[name], node)
+            to_parse = imports
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    linearizations = {}
     for name, contract in contracts.items():
-        contract.linearization = c3(name, contracts)
+        contract.linearization = c3(name, contracts, linearizations)
+        contract.linearization_set = frozenset(contract.linearization)
     return contracts
 
-def c3(contract, contracts):
+def c3(contract, contracts, cache):
+    # Shared bases are linearized only once, c3_merge doesn't mutate its input
+    if contract in cache:
+        return cache[contract]
     if contract not in contracts or not contracts[contract].base_contracts:
-        return [contract]
-    bases = contracts[contract].base_contracts
-    return [contract] + c3_merge([c3(base, contracts) for base in bases] + [bases])
+        result = [contract]
+    else:
+        bases = contracts[contract].base_contracts
+        result = [contract] + c3_merge([c3(base, contracts, cache) for base in bases] + [bases])
+    cache[contract] = result
+    return result
 
 def c3_merge(lst):
-    if not any(lst):
-        return []
-    for candidate, *_ in lst:
-        if all(candidate not in tail for _, *tail in lst):
-            rec = [tail if head == candidate else [head, *tail] for head, *tail in lst]
-            return [candidate] + c3_merge([l for l in rec if l])
-    else:
-        raise TypeError("Couldn't linearize contract")
+    # Count how many tails hold each contract, a good head appears in none
+    tail_count = collections.Counter(x for l in lst for x in l[1:])
+    lst = [collections.deque(l) for l in lst if l]
+    result = []
+    while lst:
+        for l in lst:
+            candidate = l[0]
+            if not tail_count[candidate]:
+                break
+        else:
+            raise TypeError("Couldn't linearize contract")
+        result.append(candidate)
+        for l in lst:
+            if l[0] == candidate:
+                l.popleft()
+                # The new head is no longer part of a tail
+                if l:
+                    tail_count[l[0]] -= 1
+        lst = [l for l in lst if l]
+    return result
 
 def parse_node(contract, node):
-    if node["type"] == "UsingForDeclaration":
-        typename = node["typeName"]
+    handler = PARSE_HANDLERS.get(node["type"])
+    if handler is not None:
+        handler(contract, node)
+
+def parse_usingfor(contract, node):
+    typename = node["typeName"]
+    if typename["type"] == "UserDefinedTypeName":
+        contract.usingfors[typename["namePath"]] = node["libraryName"]
+
+def parse_state_vars(contract, node):
+    for var in node["variables"]:
+        typename = var["typeName"]
         if typename["type"] == "UserDefinedTypeName":
-            contract.usingfors[typename["namePath"]] = node["libraryName"]
-    if node["type"] == "StateVariableDeclaration":
-        for var in node["variables"]:
-            typename = var["typeName"]
-            if typename["type"] == "UserDefinedTypeName":
-                contract.state_user_vars[var["name"]] = typename["namePath"]
-    if node["type"] in ["FunctionDefinition", "ModifierDefinition", "EventDefinition"]:
-        name = node["name"]
-        calls = []
-        fun_type = node["type"][:-len("Definition")]
-        if fun_type == "Function":
-            if node["isConstructor"]:
-                name = contract.name
-            calls = [Call("this", Function(x["name"], len(x["arguments"]), "Modifier"))
-                     for x in node["modifiers"]]
-        if "body" in node and node["body"]:
-            get_calls_from_dict(node["body"], calls)
-        function = Function(name, len(node["parameters"]["parameters"]), fun_type)
-        # FIXME: We cannot do this without compilation
-        if function in contract.functions:
-            eprint(f"WARNING: Overloaded function {function.name} detected")
-            eprint(f"This parser can only differentiate them by the amount of parameters")
-            eprint(f"We don't know which function to call, we are likely guessing wrong")
-        contract.functions[function] = calls
-
-def get_calls_from_dict(dictionary, function_calls, keyname=""):
-    for k, v in dictionary.items():
-        if k == "type" and v == "FunctionCall":
+            contract.state_user_vars[var["name"]] = typename["namePath"]
+
+def parse_function(contract, node):
+    name = node["name"]
+    calls = []
+    # Interned so type comparisons against literals hit the identity fast path
+    fun_type = sys.intern(node["type"][:-len("Definition")])
+    if fun_type == "Function":
+        if node["isConstructor"]:
+            name = contract.name
+        calls = [Call("this", Function(x["name"], len(x["arguments"]), "Modifier"))
+                 for x in node["modifiers"]]
+    if "body" in node and node["body"]:
+        get_calls_from_dict(node["body"], calls)
+    function = Function(name, len(node["parameters"]["parameters"]), fun_type)
+    # FIXME: We cannot do this without compilation
+    if function in contract.functions:
+        eprint(f"WARNING: Overloaded function {function.name} detected")
+        eprint(f"This parser can only differentiate them by the amount of parameters")
+        eprint(f"We don't know which function to call, we are likely guessing wrong")
+    else:
+        contract.functions_by_name.setdefault(function.name, []).append(function)
+    contract.functions[function] = calls
+
+PARSE_HANDLERS = {
+    "UsingForDeclaration": parse_usingfor,
+    "StateVariableDeclaration": parse_state_vars,
+    "FunctionDefinition": parse_function,
+    "ModifierDefinition": parse_function,
+    "EventDefinition": parse_function,
+}
+
+def get_calls_from_dict(dictionary, function_calls):
+    # Depth first walk over the AST with an explicit stack of (node, keyname)
+    Node = parser.Node
+    stack = [(dictionary, "")]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        dictionary, keyname = pop()
+        node_type = dictionary.get("type")
+        if node_type in LEAF_TYPES:
+            continue
+        if node_type == "FunctionCall":
             exp = dictionary["expression"]
+            exp_type = exp["type"]
             param_count = len(dictionary["arguments"])
             fun_type = "Event" if keyname == "eventCall" else "Function"
-            if exp["type"] == "Identifier":
+            if exp_type == "Identifier":
                 function_calls.append(Call("this", Function(exp["name"], param_count, fun_type)))
-            if exp["type"] == "MemberAccess":
-                if "name" in exp["expression"]:
+            elif exp_type == "MemberAccess":
+                member_of = exp["expression"]
+                if "name" in member_of:
                     function = Function(exp["memberName"], param_count, fun_type)
-                    function_calls.append(Call(exp["expression"]["name"], function))
-        if type(v) is parser.Node:
-            get_calls_from_dict(v, function_calls, k)
-        if type(v) is list:
-            for x in v:
-                if type(x) is parser.Node:
-                    get_calls_from_dict(x, function_calls)
-
-def walk_call(entry, ignore_list):
-    calls = [entry]
+                    function_calls.append(Call(member_of["name"], function))
+        # Push in reverse so calls keep their source order
+        for k, v in reversed(dictionary.items()):
+            if isinstance(v, Node):
+                push((v, k))
+            elif isinstance(v, list):
+                for x in reversed(v):
+                    if isinstance(x, Node):
+                        push((x, ""))
+
+def walk_call(entry, ignore_set):
+    queue = collections.deque([entry])
+    seen = {entry}
     nodes = collections.defaultdict(set)
     edges = collections.defaultdict(set)
     nodes[entry.contract].add(entry)
-    for callee in calls:
+    while queue:
+        callee = queue.popleft()
         nodes[callee.contract].add(callee)
-        if callee in ignore_list:
+        if callee in ignore_set:
             continue
-        for call in contracts[callee.contract].functions[callee.function]:
-            search_function = lambda contract : call.function in contract.functions
-            contract_to = callee.contract
+        caller_contract_name = callee.contract
+        caller_contract = contracts[caller_contract_name]
+        caller_funcs = caller_contract.functions
+        caller_edges = edges[caller_contract_name]
+        for call in caller_funcs[callee.function]:
+            call_contract = call.contract
+            call_function = call.function
             context_to = callee.context
-            if call.contract in ["this", "super"]:
+            if call_contract in SELF_REFERENCES:
                 # Internal call
-                if call.contract == "super":
+                if call_contract == "super":
                     # Search for the same function strictly in base contracts
-                    search_function = (lambda contract :
-                        not contract is contracts[callee.contract] and
-                        call.function in contract.functions)
-                    contract_to = find_base(callee.contract, search_function)
+                    contract_to = find_function_base(caller_contract, call_function,
+                                                     exclude=caller_contract_name)
                 else:
-                    contract_to = find_base(callee.context, search_function)
+                    contract_to = find_function_base(contracts[callee.context], call_function)
                 # We wishfully ignore functions we don't know (Like requires)
                 if contract_to is None:
                     continue
             else:
                 # Maybe it's a direct call to a contract base (i.e. ContractBase.foo())
-                base_name = None
-                if call.contract in contracts[callee.contract].linearization:
-                    base_name = find_base(call.contract, search_function)
-                contract_to = base_name
-                if base_name is None:
+                contract_to = None
+                if call_contract in caller_contract.linearization_set:
+                    contract_to = find_function_base(contracts[call_contract], call_function)
+                if contract_to is None:
                     # External call
                     # Search for the base contract holding the state variable
-                    search_var = lambda contract : call.contract in contract.state_user_vars
-                    base_name = find_base(callee.contract, search_var)
+                    base_name = find_var_base(caller_contract, call_contract)
                     # We may not have the contract that holds the state variable
                     if base_name is None:
                         continue
-                    contract_to = contracts[base_name].state_user_vars[call.contract]
+                    base_contract = contracts[base_name]
+                    contract_to = base_contract.state_user_vars[call_contract]
                     context_to = base_name
                     if contract_to not in contracts:
                         # Maybe it's a struct used with a library, not a contract
-                        search_using = lambda contract : contract_to in contract.usingfors
-                        base_usingfor = find_base(base_name, search_using)
+                        base_usingfor = find_usingfor_base(base_contract, contract_to)
                         contract_to = contracts[base_usingfor].usingfors[contract_to]
-                        lib_function = Function(call.function.name, call.function.params + 1)
-                        search_function = lambda contract : lib_function in contract.functions
-            call_to = Call(contract_to, call.function, context_to)
-            edges[callee.contract].add(Edge(callee, call_to))
-            if not call_to in calls: 
-                calls.append(call_to)
+            call_to = Call(contract_to, call_function, context_to)
+            caller_edges.add(Edge(callee, call_to))
+            if call_to not in seen:
+                seen.add(call_to)
+                queue.append(call_to)
     return (nodes, edges)
 
 
-def find_base(contract_name, predicate):
-    for base_name in contracts[contract_name].linearization:
-        if base_name in contracts and predicate(contracts[base_name]):
-            return base_name
-    return None
+def find_base(contract, attribute, key, exclude=None):
+    # Return the first base in the linearization whose attribute holds key
+    cache = contract.base_cache
+    cache_key = (attribute, key, exclude)
+    if cache_key not in cache:
+        cache[cache_key] = None
+        for base_name in contract.linearization:
+            if (base_name != exclude and base_name in contracts and
+                key in getattr(contracts[base_name], attribute)):
+                cache[cache_key] = base_name
+                break
+    return cache[cache_key]
+
+def find_function_base(contract, function, exclude=None):
+    return find_base(contract, "functions", function, exclude)
+
+def find_var_base(contract, var_name):
+    return find_base(contract, "state_user_vars", var_name)
+
+def find_usingfor_base(contract, typename):
+    return find_base(contract, "usingfors", typename)
 
-def print_digraph(nodes, edges, ignore_list):
-    print("digraph function_graph {")
-    print("concentrate = true;")
-    print("newrank = true;")
-    print("overlap = false;")
-    print("edge [color=red];")
+def print_digraph(nodes, edges, ignore_set):
+    out = []
+    append = out.append
+    append("digraph function_graph {")
+    append("concentrate = true;")
+    append("newrank = true;")
+    append("overlap = false;")
+    append("edge [color=red];")
     for contract, calls in nodes.items():
-        print(f"subgraph cluster_{contract} {{")
-        print(f"    label = {contract};")
-        print(f"    color = blue;")
-        print(f"    edge [color=black]")
+        append(f"subgraph cluster_{contract} {{")
+        append(f"    label = {contract};")
+        append(f"    color = blue;")
+        append(f"    edge [color=black]")
 
         for call in calls:
-            shapes = {"Function": "box", "Modifier": "house", "Event": "oval"}
             name = call.function.name or "\"Fallback Function\""
-            style = "dashed" if call in ignore_list else "solid";
-            print(f"    \"{call}\" [label={name}, style={style}, shape={shapes[call.function.type]}]")
+            style = "dashed" if call in ignore_set else "solid";
+            append(f"    \"{call}\" [label={name}, style={style}, shape={SHAPES[call.function.type]}]")
         for edge in edges[contract]:
             if edge.callee.contract == contract:
-                print(f"    \"{edge.caller}\" -> \"{edge.callee}\"")
-        print("}")
+                append(f"    \"{edge.caller}\" -> \"{edge.callee}\"")
+        append("}")
 
     for contract, edges in edges.items():
         for edge in edges:
             if edge.callee.contract != contract:
                 if edge.caller.context == edge.callee.context:
-                    print(f"    \"{edge.caller}\" -> \"{edge.callee}\" [color=black]")
+                    append(f"    \"{edge.caller}\" -> \"{edge.callee}\" [color=black]")
                 else:                
-                    print(f"    \"{edge.caller}\" -> \"{edge.callee}\"")
+                    append(f"    \"{edge.caller}\" -> \"{edge.callee}\"")
 
-    print("}")
+    append("}")
+    sys.stdout.write("\n".join(out))
+    sys.stdout.write("\n")
 
 if __name__ == "__main__":
     if len(sys.argv) == 1 or (len(sys.argv) == 2 and sys.argv[1] in ["-h", "--help"]):
@@ -280,6 +400,7 @@ if __name__ == "__main__":
             if len(call) != 3:
                 sys.exit(f"Bad call count {ignore}")
             ignore_list.append(Call(call[0], Function(call[1], int(call[2]))))
+    ignore_set = frozenset(ignore_list)
     if not os.path.isfile(args.file):
         sys.exit(f"Couldn't find file {args.file}")
     file_param = os.path.realpath(args.file)
@@ -294,8 +415,9 @@ if __name__ == "__main__":
     # Look for matching functions
     FunctionBase = collections.namedtuple("FunctionBase", "fun base")
     bases = contracts[contract_name].linearization
-    functions = (FunctionBase(f, b) for b in bases if b in contracts for f in contracts[b].functions)
-    functions = [f for f in functions if f.fun.name == args.function and f.fun.type == "Function"]
+    functions = [FunctionBase(f, b) for b in bases if b in contracts
+                 for f in contracts[b].functions_by_name.get(args.function, ())
+                 if f.type == "Function"]
     if not functions:
         sys.exit(f"Couldn't find function {args.function}")
     if not args.count is None:
@@ -307,6 +429,6 @@ if __name__ == "__main__":
         eprint(f"This script cannot differentiate between two functions")
         eprint(f"with the same name and amount of parameters but different types")
         eprint(f"since that requires more compiler information that we do not have")
-    (nodes, edges) = walk_call(Call(contract_name, functions[0].fun), ignore_list)
+    (nodes, edges) = walk_call(Call(contract_name, functions[0].fun), ignore_set)
     # Print the resulting graph
-    print_digraph(nodes, edges, ignore_list)
+    print_digraph(nodes, edges, ignore_set)